@@ -1,5 +1,7 @@
 import tensorflow as tf
+import argparse
 import collections
+import functools
 import numpy as np
 import gymnasium as gym
 import matplotlib.pyplot as plt
@@ -7,9 +9,8 @@ import tqdm
 import atexit
 import os
 import statistics
-from skimage.transform import resize
-from typing import Any
-import gc
+import threading
+import cv2
 
 # import maths
 
@@ -22,22 +23,24 @@ frames_to_skip = 4
 frames_memory_length = 4
 max_episodes = 500
 epsilon = 1
-epsilon_random_episodes = max_episodes * 0.2
 epsilon_terminal_value = 0.05
-epsilon_decay = (epsilon - epsilon_terminal_value) / (
-    (max_episodes - epsilon_random_episodes) * 0.99
-)
 human_intuition_chance = 0.5
 learning_rate = 1e-3
 gamma = 0.99  # Discount factor for past rewards
 end_game_reward_shape = -0.5
 trainning_epoche_episodes_len = 50
+replay_memory_length = 100_000
+batch_size = 64
+replay_prefetch_batches = 4
+train_frames_interval = frames_to_skip * 4
+mixed_precision = True  # float16 compute on GPU tensor cores
 
 # Env Params
 env_name = "ALE/Breakout-v5"
 render_mode = "rgb_array"
 repeat_action_probability = 0
 obs_type = "grayscale"
+envs_num = 16  # Parallel environments, stepped asynchronously
 model_file_name = os.path.dirname(__file__) + "/model"
 train_model = True
 load_weights = True
@@ -46,108 +49,149 @@ save_weights = True
 # Plot Params
 running_reward_interval = 16
 
-# Demo
-# max_episodes = 1
-# render_mode = "human"
-# train_model = False
-# trainning_epoche_episodes_len = 10
-# load_weights = False
-# save_weights = False
-# learning_rate = 1e-1
-# epsilon = 0
-# epsilon_random_episodes = max_episodes * 0.2
-# running_reward_interval = 1
-# epsilon_decay = (epsilon - epsilon_terminal_value) / (
-#     (max_episodes - epsilon_random_episodes) * 0.99
-# )
-# trainning_epoche_episodes_len = 10
-# human_intuition_chance = 0.8
-
-
-class FramesState(collections.deque):
-    """Stores a series of frames"""
-
-    reward: float = 0
+
+class FramesState:
+    """Stores a series of frames stacked on the channels axis of a preallocated array, oldest frame first"""
 
     def __init__(self, maxlen=frames_memory_length):
-        super().__init__(maxlen=maxlen)
+        self.maxlen = maxlen
+        self.frames = np.zeros((80, 80, maxlen), dtype=np.uint8)
+        self.length = 0
+        self.reward: float = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.frames[..., index]
 
     def add_frame(self, frame: np.ndarray, reward):
-        """Reduce the image center to 80x80 frame"""
+        """Reduce the image center to 80x80 frame, and shift it into the series"""
         cropped_frame = frame[33:-17]
-        img_resized: np.ndarray[Any, Any] = resize(
-            cropped_frame, output_shape=(80, 80), anti_aliasing=True
+        img_resized = cv2.resize(cropped_frame, (80, 80), interpolation=cv2.INTER_AREA)
+        self.frames[..., :-1] = self.frames[..., 1:]
+        self.frames[..., -1] = np.where(
+            img_resized > 0.01 * 255, np.uint8(255), np.uint8(0)
         )
-        black_white = np.where(img_resized > 0.01, 255, 0)
-        super().append(black_white)
+        self.length = min(self.length + 1, self.maxlen)
         self.reward += reward
 
-    def reset(self):
-        self.clear()
-        while int(self.maxlen or 0) < frames_memory_length:
-            super().append(np.zeros((80, 80), dtype=np.float32))
-        self.reward = 0
-
-    def copyFromFrame(self, framesState):
-        # TODO fix rewards update
-        super().append(framesState[0])
-        super().append(framesState[1])
-        super().append(framesState[2])
-        super().append(framesState[3])
-        self.reward = framesState.reward
-
-    def copy(self):
-        return [self[0].copy(), self[1].copy(), self[2].copy(), self[3].copy()]
-
     def clear(self):
+        self.frames.fill(0)
+        self.length = 0
         self.reward = 0
-        super().clear()
-
-    def getTensor(self) -> tf.Tensor:
-        return tf.expand_dims(self.copy(), axis=0)
 
 
-class FrameHistory:
-    """This calss stores the history of frames.
-    Used for Batch update of the model"""
+def get_states(frames_states: list[FramesState]) -> np.ndarray:
+    """Stack the frames series of all environments into a single batch"""
+    return np.stack([frames_state.frames for frames_state in frames_states])
+
+
+class ReplayMemory:
+    """Stores the experience in preallocated arrays, one array per field.
+    Each state is stored once as uint8 (the frames are black & white), a transition points to its next state"""
+
+    def __init__(self, maxlen=replay_memory_length):
+        self.maxlen = maxlen
+        self.states = np.zeros((maxlen, 80, 80, frames_memory_length), dtype=np.uint8)
+        self.actions = np.zeros(maxlen, dtype=np.int32)
+        self.rewards = np.zeros(maxlen, dtype=np.float32)
+        self.dones = np.zeros(maxlen, dtype=np.float32)
+        self.next_states = np.zeros(maxlen, dtype=np.int64)
+        # A state is a valid transition once its action, reward and next state are collected
+        self.transitions = np.zeros(maxlen, dtype=np.bool_)
+        self.transitions_num = 0
+        self.index = 0
+        self.rng = np.random.default_rng()
+        # The mini-batches are sampled on a tf.data background thread
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.transitions_num
+
+    def add_state(self, state: np.ndarray) -> int:
+        """Store a state, overriding the oldest one. Returns the state index"""
+        with self.lock:
+            index = self.index
+            if self.transitions[index]:
+                self.transitions[index] = False
+                self.transitions_num -= 1
+            self.states[index] = state
+            self.index = (index + 1) % self.maxlen
+        return index
+
+    def add_transition(
+        self, state_index: int, action, reward, next_state_index: int, done
+    ):
+        """Collect the transition from a stored state to its stored next state"""
+        with self.lock:
+            self.actions[state_index] = action
+            self.rewards[state_index] = reward
+            self.dones[state_index] = done
+            self.next_states[state_index] = next_state_index
+            self.transitions[state_index] = True
+            self.transitions_num += 1
+
+    def sample(self, sample_size=batch_size):
+        """Sample a mini-batch of (states, actions, rewards, next_states, dones)"""
+        with self.lock:
+            indices = self.rng.choice(
+                np.flatnonzero(self.transitions), size=sample_size, replace=False
+            )
+            return (
+                self.states[indices],
+                self.actions[indices],
+                self.rewards[indices],
+                self.states[self.next_states[indices]],
+                self.dones[indices],
+            )
 
-    current_states: list[FramesState] = []
-    actions: list[int] = []
-    rewards: list[float] = []
-    next_states: list[FramesState] = []
 
-    def __init__(self):
-        pass
+def sample_replay(replay: ReplayMemory, sample_size=batch_size):
+    """Endlessly sample mini-batches from the replay memory"""
+    while True:
+        yield replay.sample(sample_size)
 
-    def collect(self, current_state, action, reward, next_state):
-        self.current_states.append(current_state.copy())
-        self.actions.append(action)
-        self.rewards.append(reward)
-        self.next_states.append(next_state.copy())
 
-    def clear(self):
-        self.current_states.clear()
-        self.actions.clear()
-        self.rewards.clear()
-        self.next_states.clear()
+def get_replay_dataset(replay: ReplayMemory) -> tf.data.Dataset:
+    """Sample the replay memory mini-batches on a background thread, prefetched ahead of the training"""
+    states_spec = tf.TensorSpec(
+        shape=(batch_size, 80, 80, frames_memory_length), dtype=tf.uint8
+    )
+    dataset = tf.data.Dataset.from_generator(
+        lambda: sample_replay(replay),
+        output_signature=(
+            states_spec,
+            tf.TensorSpec(shape=(batch_size,), dtype=tf.int32),
+            tf.TensorSpec(shape=(batch_size,), dtype=tf.float32),
+            states_spec,
+            tf.TensorSpec(shape=(batch_size,), dtype=tf.float32),
+        ),
+    )
+    # A few batches ahead, so the batches are sampled from a recent replay memory
+    return dataset.prefetch(replay_prefetch_batches)
 
 
 class Model(tf.keras.Sequential):
     """Deep Q-Learning algorithem, updates a trainng model on each batch.
     Train the target model periodically"""
 
-    def __init__(self):
+    def __init__(self, train=True):
         super().__init__()
 
-        # Make Sequenctial-visual model accepts n frames sequence
+        # Make visual model accepts n frames stacked as channels (as in the DQN paper)
         self.training_model = tf.keras.Sequential(
             [
-                tf.keras.layers.ConvLSTM2D(
-                    16,
+                # The frames are fed as uint8, and normalized on device
+                tf.keras.layers.Input(
+                    shape=(80, 80, frames_memory_length), dtype=tf.uint8, name="input"
+                ),
+                tf.keras.layers.Rescaling(1 / 255),
+                tf.keras.layers.Conv2D(
+                    filters,
                     kernel_size=8,
-                    input_shape=(4, 80, 80, 1),
-                    padding="same",
                     strides=4,
+                    activation=tf.keras.activations.relu,
                 ),
                 tf.keras.layers.Conv2D(
                     32,
@@ -157,75 +201,96 @@ class Model(tf.keras.Sequential):
                 ),
                 tf.keras.layers.Flatten(),
                 tf.keras.layers.Dense(256, activation=tf.keras.activations.relu),
+                # Keep the Q values output in float32 for numeric stability
                 tf.keras.layers.Dense(
                     actions_num,
                     activation=tf.keras.activations.linear,
                     name="output-layer",
+                    dtype=tf.float32,
                 ),
             ]
         )
-        self.training_model.compile(
-            optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
-            loss=tf.keras.losses.Huber(),
-        )
-        # Training model used for training, and not for taking actions. This would allow a batch update of the model policy.
-        self.target_model = tf.keras.models.clone_model(self.training_model)
+        if train:
+            optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+            if tf.keras.mixed_precision.global_policy().name == "mixed_float16":
+                # Scale the loss to avoid float16 gradients underflow
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+            self.training_model.compile(
+                optimizer=optimizer,
+                loss=tf.keras.losses.Huber(),
+            )
+            # Training model used for training, and not for taking actions. This would allow a batch update of the model policy.
+            self.target_model = tf.keras.models.clone_model(self.training_model)
+            # clone_model initializes new weights, start with the training model weights
+            self.target_model.set_weights(self.training_model.get_weights())
+        else:
+            # Without training there is no need for the target model and the optimizer state
+            self.target_model = self.training_model
 
         self.training_model.summary()
 
-    def get_action(self, frames_state: FramesState):
-        time_series = frames_state.getTensor()
-        action = self._get_action(time_series)
-        return action.numpy()  # type: ignore
-
-    @tf.function
-    def _get_action(self, frames_state_tensor):
-        # Inner @tf.function for increased performence
-        action_probs = self.training_model(frames_state_tensor, training=False)
-        action = tf.argmax(action_probs, axis=1)
-        return action[0]
-
-    def train(self, reply_history: FrameHistory):
-        """Train the training model with the observations"""
+    def get_actions(self, states: np.ndarray):
+        """Get the actions of all environments with a single batched model call"""
+        time_series = tf.convert_to_tensor(states, dtype=tf.uint8)
+        actions = self._get_actions(time_series)
+        # The only device to host copy of the action selection, an int32 per environment
+        return actions.numpy()  # type: ignore
+
+    @tf.function(jit_compile=True)
+    def _get_actions(self, frames_states_tensor):
+        # Inner XLA compiled @tf.function for increased performence, the argmax is fused into the model call
+        action_probs = self.training_model(frames_states_tensor, training=False)
+        return tf.argmax(action_probs, axis=1, output_type=tf.int32)
+
+    @tf.function(jit_compile=True)
+    def train(self, states, actions, rewards, next_states, dones):
+        """Train the training model with a mini-batch of replayed transitions"""
         # Deep Q-Learning Algorithem
-        #   1. Predict future Q values based on next_state
-        #   2. Mask actions * observed rewards
-        #   3. Calculate updated q values based on the action taken
-        #   4. Fit the model based on the taken observation -> [action] = new_q_value
-
-        next_states_tensor = Model.get_state_tensor(reply_history.next_states)
-        # next_states_sequence = FramesTensorSequence(reply_history.next_states)
-        predicated_next_q_values = self.target_model.predict(next_states_tensor)
-
-        masks = tf.one_hot(
-            reply_history.actions, actions_num, dtype=tf.float32, name="masks"
-        )
-        rewards = tf.constant(reply_history.rewards, dtype=tf.float32, name="rewards")
-        rewards = tf.reshape(rewards, shape=(len(rewards), 1))
-        reward_mask = tf.multiply(masks, rewards, name="reward_mask")
-
-        updated_q_values = tf.add(reward_mask, gamma * predicated_next_q_values)
-
-        current_states_tensor = tf.convert_to_tensor(
-            reply_history.current_states, dtype=tf.float32, name="current_states_tensor"
+        #   1. Predict the stable future Q values based on next_states (target model)
+        #   2. Calculate updated q values: reward + gamma * max(Q(next_state)), unless done
+        #   3. Gather the training model Q values of the actions taken
+        #   4. Apply the Huber loss gradients on the training model
+        optimizer = self.training_model.optimizer
+        stable_q = tf.reduce_max(
+            self.target_model(next_states, training=False), axis=1
         )
+        updated_q_values = rewards + gamma * stable_q * (1 - dones)
+
+        with tf.GradientTape() as tape:
+            action_probs = self.training_model(states, training=True)
+            q_values = tf.gather(action_probs, actions, batch_dims=1)
+            loss = self.training_model.loss(updated_q_values, q_values)
+            if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                scaled_loss = optimizer.get_scaled_loss(loss)
+
+        variables = self.training_model.trainable_variables
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            scaled_gradients = tape.gradient(scaled_loss, variables)
+            gradients = optimizer.get_unscaled_gradients(scaled_gradients)
+        else:
+            gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+        return loss
 
-        self.training_model.fit(current_states_tensor, updated_q_values)
-        self.target_model.set_weights(self.training_model.get_weights())
+    @tf.function
+    def update_target_model(self):
+        """Sync the target model with the training model, on device"""
+        for training_weight, target_weight in zip(
+            self.training_model.weights, self.target_model.weights
+        ):
+            target_weight.assign(training_weight)
 
     def load_weights(self, file_name):
         try:
             self.training_model.load_weights(file_name)
-            self.target_model.load_weights(file_name)
+            if self.target_model is not self.training_model:
+                self.target_model.load_weights(file_name)
         except:
             print(f"Loading model wasn't found in: {model_file_name}")
 
     def save_weights(self, file_name):
-        self.target_model.save_weights(file_name)
-
-    @staticmethod
-    def get_state_tensor(state):
-        return map(lambda ns: tf.expand_dims(ns, axis=0), state)
+        # The training model has the latest training, the target model is synced periodically
+        self.training_model.save_weights(file_name)
 
 
 def get_action_by_simple_human_intuition(framesState: FramesState) -> int:
@@ -266,135 +331,248 @@ def get_action_by_simple_human_intuition(framesState: FramesState) -> int:
         return 3
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number, got: {value}")
+    return number
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Deep Q-Learning Atari Breakout")
+    parser.add_argument(
+        "--train",
+        action=argparse.BooleanOptionalAction,
+        default=train_model,
+        help="train the model, or only play it (--no-train)",
+    )
+    parser.add_argument(
+        "--episodes", type=positive_int, default=max_episodes, help="episodes to run"
+    )
+    parser.add_argument(
+        "--render",
+        action="store_true",
+        help="render a single environment on screen",
+    )
+    parser.add_argument(
+        "--load",
+        action=argparse.BooleanOptionalAction,
+        default=load_weights,
+        help=f"load the model weights from: {model_file_name}",
+    )
+    parser.add_argument(
+        "--save",
+        action=argparse.BooleanOptionalAction,
+        default=save_weights,
+        help=f"save the model weights to: {model_file_name} (only when training)",
+    )
+    return parser.parse_args()
+
+
+def make_env(render_mode: str) -> gym.Env:
+    return gym.make(
+        env_name,
+        render_mode=render_mode,
+        repeat_action_probability=repeat_action_probability,
+        obs_type=obs_type,
+        mode=4,
+        disable_env_checker=True,
+        lives=1,
+    )
+
+
 # Main
-print("Num GPUs Available: ", len(tf.config.list_physical_devices("GPU")))
-
-model = Model()
-
-# load and save weights
-if load_weights:
-    model.load_weights(model_file_name)
-if save_weights:
-    atexit.register(model.save_weights, model_file_name)
-
-current_frames = FramesState(maxlen=frames_memory_length)
-prev_frames = FramesState(maxlen=frames_memory_length)
-
-frames_history = FrameHistory()
-
-env = gym.make(
-    env_name,
-    render_mode=render_mode,
-    repeat_action_probability=repeat_action_probability,
-    obs_type=obs_type,
-    mode=4,
-    disable_env_checker=True,
-    lives=1,
-)
-
-
-print(env.ale.lives())
-total_frames = 0
-episodes_reward: collections.deque[int] = collections.deque(
-    maxlen=running_reward_interval,
-)
-rewards: list[float] = []
-
-# Training episode loop
-max_episodes_tqdm = tqdm.trange(max_episodes)
-for episode in max_episodes_tqdm:
-    current_frames.clear()
-    prev_frames.clear()
-    frame, info = env.reset()
-
-    current_frames.add_frame(frame, 0)
-    action = 1  # fire the ball
-    done = False
-    episode_reward = 0
+if __name__ == "__main__":
+    args = parse_args()
+    train_model = args.train
+    max_episodes = args.episodes
+    load_weights = args.load
+    # Without training there is nothing new to save, and a failed load would override the file
+    save_weights = args.save and train_model
+    if args.render:
+        render_mode = "human"
+        envs_num = 1
+    if not train_model:
+        epsilon = 0  # Only exploit the loaded model
+
+    epsilon_random_episodes = max_episodes * 0.2
+    epsilon_decay = (epsilon - epsilon_terminal_value) / (
+        (max_episodes - epsilon_random_episodes) * 0.99
+    )
+
+    print("Num GPUs Available: ", len(tf.config.list_physical_devices("GPU")))
+    tf.config.optimizer.set_jit(True)
+    if mixed_precision and tf.config.list_physical_devices("GPU"):
+        tf.keras.mixed_precision.set_global_policy("mixed_float16")
+
+    model = Model(train=train_model)
+
+    # load and save weights
+    if load_weights:
+        model.load_weights(model_file_name)
+    if save_weights:
+        atexit.register(model.save_weights, model_file_name)
+
+    current_frames = [FramesState(frames_memory_length) for _ in range(envs_num)]
+    prev_states = np.zeros(envs_num, dtype=np.int64)  # replay memory indices
+    has_prev_state = np.zeros(envs_num, dtype=np.bool_)
+
+    replay = ReplayMemory(maxlen=replay_memory_length)
+    replay_batches = None  # Started once the replay memory has a mini-batch
+
+    # Step all the environments together, each in its own process
+    envs = gym.vector.AsyncVectorEnv(
+        [functools.partial(make_env, render_mode)] * envs_num
+    )
+
+    total_frames = 0
+    episodes_reward: collections.deque[int] = collections.deque(
+        maxlen=running_reward_interval,
+    )
+    rewards: list[float] = []
+    fire_actions = np.ones(envs_num, dtype=np.int64)
+    # Training is done on action steps, keeping a train step per train_frames_interval frames
+    untrained_frames = 0
+
+    frames, infos = envs.reset()
+    for i in range(envs_num):
+        current_frames[i].add_frame(frames[i], 0)
+    actions = fire_actions.copy()  # fire the ball
+    envs_reward = np.zeros(envs_num)
+    episode = 0
     step = 0
 
-    # Training frames Loop
-    while done != True:
-        total_frames += 1
+    rng = np.random.default_rng()
+
+    # Hoist the envs and replay memory method lookups out of the frames loop
+    step_async = envs.step_async
+    step_wait = envs.step_wait
+    add_state = replay.add_state
+    add_transition = replay.add_transition
+
+    # Training frames Loop, the environments are auto reset when their episode is done
+    max_episodes_tqdm = tqdm.tqdm(total=max_episodes)
+    while episode < max_episodes:
+        total_frames += envs_num
         step += 1
-        if step % frames_to_skip != 0:
-            # Interact with the environemnt (no action)
-            frame, reward, terminated, truncated, info = env.step(1)
-            done = terminated or truncated
-            episode_reward += reward
 
-            if done and end_game_reward_shape is not None:
-                # Reward shaping, if the game is done, reduce the reward (less then 1, incase the game over due to braking the last break)
-                reward += end_game_reward_shape
+        if step % frames_to_skip == 0:
+            # Stack the states once, used for both the replay memory and the action selection
+            states = get_states(current_frames)
+
+            # Collect the experience into the replay memory, and prepare for next step
+            if train_model:
+                for i in range(envs_num):
+                    state_index = add_state(states[i])
+                    if has_prev_state[i]:
+                        add_transition(
+                            prev_states[i],
+                            actions[i],
+                            current_frames[i].reward,
+                            state_index,
+                            False,
+                        )
+                    prev_states[i] = state_index
+                has_prev_state[:] = True
+
+            # epsilon-greedy selection, a single model call for all the greedy environments
+            # (the random draws of all the environments are sampled at once)
+            greedy = rng.random(envs_num) >= epsilon
+            human_intuition = rng.random(envs_num) < human_intuition_chance
+            actions[:] = rng.integers(0, actions_num, envs_num)
+            if greedy.any():
+                actions[greedy] = model.get_actions(states)[greedy]
+            for i in np.flatnonzero(~greedy & human_intuition):
+                actions[i] = get_action_by_simple_human_intuition(current_frames[i])
+
+            # Take action and prepare next series
+            for i in range(envs_num):
+                current_frames[i].clear()
+            step_async(actions)
+
+            # Train the model on mini-batches sampled from the replay memory, while the environments step
+            if train_model and len(replay) >= batch_size:
+                if replay_batches is None:
+                    replay_batches = iter(get_replay_dataset(replay))
+                untrained_frames += frames_to_skip * envs_num
+                while untrained_frames >= train_frames_interval:
+                    model.train(*next(replay_batches))
+                    untrained_frames -= train_frames_interval
+        else:
+            # Interact with the environemnt (no action), the skipped frames only accumulate rewards
+            step_async(fire_actions)
 
-            current_frames.add_frame(frame, reward)
+        frames, envs_step_reward, terminated, truncated, infos = step_wait()
+        dones = terminated | truncated
+        envs_reward += envs_step_reward
 
-            if done is False:
+        for i in range(envs_num):
+            reward = envs_step_reward[i]
+            if not dones[i]:
+                current_frames[i].add_frame(frames[i], reward)
                 continue
-            else:
+
+            if end_game_reward_shape is not None:
+                # Reward shaping, if the game is done, reduce the reward (less then 1, incase the game over due to braking the last break)
+                reward += end_game_reward_shape
+
+            # The environment was auto reset, frames[i] is already the next episode first frame
+            final_frame = infos["final_observation"][i]
+            current_frames[i].add_frame(final_frame, reward)
+            if has_prev_state[i]:
                 # Collect the end game observation (no additional actions, and rewards)
-                while len(current_frames) < frames_memory_length:
-                    current_frames.add_frame(frame, 0)
-                frames_history.collect(
-                    prev_frames, action, current_frames.reward, current_frames
+                while len(current_frames[i]) < frames_memory_length:
+                    current_frames[i].add_frame(final_frame, 0)
+                add_transition(
+                    prev_states[i],
+                    actions[i],
+                    current_frames[i].reward,
+                    add_state(current_frames[i].frames),
+                    True,
                 )
-            continue
 
-        # Collect the experience into batch, and prepare for next step
-        if len(prev_frames) > 0:
-            frames_history.collect(
-                prev_frames, action, prev_frames.reward, current_frames
+            # Print post episode
+            episode_reward = envs_reward[i]
+            episodes_reward.append(int(episode_reward))
+            if episode % running_reward_interval == 0:
+                rewards.append(statistics.mean(episodes_reward))
+
+            # epsilon decay
+            if episode > epsilon_random_episodes and epsilon > epsilon_terminal_value:
+                epsilon -= epsilon_decay
+
+            if (
+                train_model
+                and episode > 0
+                and episode % trainning_epoche_episodes_len == 0
+            ):
+                model.update_target_model()
+                if save_weights:
+                    model.save_weights(model_file_name)
+
+            max_episodes_tqdm.update()
+            max_episodes_tqdm.set_postfix(
+                episode=episode,
+                reward=episode_reward,
+                epsilon=epsilon,
+                total_frames=total_frames,
             )
-        prev_frames.clear()
-        prev_frames.copyFromFrame(current_frames)
-
-        # epsilon-greedy selection
-        if np.random.random() < epsilon:
-            if np.random.random() < human_intuition_chance:
-                action = get_action_by_simple_human_intuition(current_frames)
-            else:
-                action = env.action_space.sample()
-        else:
-            action = model.get_action(current_frames)
-
-        # Take action and prepare next series
-        current_frames.clear()
-        frame, reward, terminated, truncated, info = env.step(action)
-        done = terminated or truncated
-        if done and end_game_reward_shape is not None:
-            # Reward shaping, if the game is done, reduce the reward (less then 1, incase the game over due to braking the last break)
-            reward += end_game_reward_shape
-        current_frames.add_frame(frame, reward)
-        episode_reward += reward
-
-    # Print post episode
-    episodes_reward.append(int(episode_reward))
-    if episode % running_reward_interval == 0:
-        rewards.append(statistics.mean(episodes_reward))
-
-    # epsilon decay
-    if episode > epsilon_random_episodes and epsilon > epsilon_terminal_value:
-        epsilon -= epsilon_decay
-
-    if train_model and episode > 0 and episode % trainning_epoche_episodes_len == 0:
-        model.train(frames_history)
-        frames_history.clear()
-        gc.collect()
-        if save_weights:
-            model.save_weights(model_file_name)
-
-    max_episodes_tqdm.set_postfix(
-        episode=episode,
-        reward=episode_reward,
-        epsilon=epsilon,
-        total_frames=total_frames,
-    )
-
-# Plot Rewards Progression
-steps = np.array(range(0, len(rewards), 1))
-plt.plot(steps, rewards)
-plt.ylabel("Reward")
-plt.xlabel("Episode")
-plt.ylim()
-plt.title("Rewards Progression")
-plt.show()
+            episode += 1
+
+            # Start the next episode
+            current_frames[i].clear()
+            has_prev_state[i] = False
+            current_frames[i].add_frame(frames[i], 0)
+            actions[i] = 1  # fire the ball
+            envs_reward[i] = 0
+
+    envs.close()
+
+    # Plot Rewards Progression
+    steps = np.array(range(0, len(rewards), 1))
+    plt.plot(steps, rewards)
+    plt.ylabel("Reward")
+    plt.xlabel("Episode")
+    plt.ylim()
+    plt.title("Rewards Progression")
+    plt.show()
@@ -4,6 +4,7 @@ import numpy as np
 import statistics
 import tqdm
 import matplotlib.pyplot as plt
+from numba import njit
 
 # Hyperparameters
 learning_rate = 0.1
@@ -23,7 +24,9 @@ optimazeReward = True
 
 # Set seed for experiment reproducibility
 seed = 42
-np.random.seed(seed)
+rng = np.random.default_rng(seed)
+# Random numbers are drawn in blocks, instead of a call per step
+random_block_size = 1 << 16
 
 mean_reward = 0
 mean_max_x = 0
@@ -44,6 +47,50 @@ render_mode = None
 env = gym.make(env_name, render_mode=render_mode)
 
 
+# Numba compiled kernels of the Qtable hot loop.
+# The qTable is flat, a discrete state row starts at ds[0]*s1 + ds[1]*s2 and has s2 (actions) values
+@njit(cache=True)
+def discretize_state(state, low, inv_discretize_array):
+    """Set the discrete state observetion length"""
+    return np.rint((state - low) * inv_discretize_array).astype(np.intp)
+
+
+@njit(cache=True)
+def row_argmax(qTable, idx):
+    """Unrolled argmax of the 3 actions row (MountainCar-v0), first best action on ties as np.argmax"""
+    a0 = qTable[idx]
+    a1 = qTable[idx + 1]
+    a2 = qTable[idx + 2]
+    if a0 >= a1 and a0 >= a2:
+        return 0
+    return 1 if a1 >= a2 else 2
+
+
+@njit(cache=True)
+def q_action(qTable, s1, s2, ds):
+    """Get the best action of a discrete state"""
+    return row_argmax(qTable, ds[0]*s1 + ds[1]*s2)
+
+
+@njit(cache=True)
+def q_step(qTable, s1, s2, n_first, low, inv_discretize_array, ds1, action,
+           reward, next_state, alpha, gamma, optimaze_reward):
+    """Update the current value (Q_v_t: [state_t, action_t]) with the reward, and the expected value (Q_v_t+1) following the policy.
+    Returns the discrete next state"""
+    ds2 = discretize_state(next_state, low, inv_discretize_array)
+    if optimaze_reward:
+        # Optimaze the rewards for faster learning
+        reward = ds2[0] - (n_first + reward)
+    # update the (state_t, action_t) with the optimazed reward, and the following rewards from following the policy SUM(state_t+1...n, action_t+1...n)
+    idx1 = ds1[0]*s1 + ds1[1]*s2 + action
+    idx2 = ds2[0]*s1 + ds2[1]*s2
+    delta = alpha*(reward +
+                   gamma * qTable[idx2 + row_argmax(qTable, idx2)]
+                   - qTable[idx1])
+    qTable[idx1] += delta
+    return ds2
+
+
 class Qtable():
     def __init__(self, env: gym.Env):
         """Build empty Qtable"""
@@ -53,44 +100,50 @@ class Qtable():
                       env.observation_space.low) / discretize_array
         temp_array = np.round(temp_array, 0).astype(int) + 1
         temp_array = np.append(temp_array, env.action_space.n)
-        self.qTable = np.zeros(temp_array)
+        # Flat contiguous qTable, indexed with the strides of its shape
+        self.shape = tuple(temp_array)
+        self.qTable = np.zeros(int(np.prod(self.shape)), np.float32)
+        self.s1 = self.shape[1] * self.shape[2]
+        self.s2 = self.shape[2]
+        assert self.s2 == 3, "row_argmax is unrolled for 3 actions"
+
+        # Cached for discretizeState, multiplying by the inverse instead of dividing
+        self.low = env.observation_space.low
+        self.inv_discretize_array = 1 / np.array(discretize_array)
 
     def __call__(self, state) -> int:
         """Call the model and get action"""
-        ds = Qtable.discretizeState(state, self.env)
-        return np.argmax(self.qTable[ds[0], ds[1]])
-
-    def train(self, state, action, reward, next_state) -> int:
-        """Update the current value (Q_v_t: [state_t, action_t]) with the reward, and the expected value (Q_v_t+1) following the policy"""
-        ds1 = Qtable.discretizeState(state, self.env)
-        ds2 = Qtable.discretizeState(next_state, self.env)
-        optimazed_reward = Qtable.optimazeReward(reward, ds2, self.qTable)
-        # update the (state_t, action_t) with the optimazed_reward, and the following rewards from following the policy SUM(state_t+1...n, action_t+1...n)
-        delta = learning_rate*(optimazed_reward +
-                               discount_rate *
-                               np.max(self.qTable[ds2[0], ds2[1]])
-                               - self.qTable[ds1[0], ds1[1], action])
-        self.qTable[ds1[0], ds1[1], action] += delta
-
-    def updateDone(self, state, action, reward):
-        ds = Qtable.discretizeState(state, self.env)
-        self.qTable[ds[0], ds[1], action] = reward
+        return self.getAction(self.discretizeState(state))
+
+    def getAction(self, ds) -> int:
+        """Get the action of a discrete state"""
+        return q_action(self.qTable, self.s1, self.s2, ds)
+
+    def train(self, ds1, action, reward, next_state):
+        """Update the current value with the reward, and return the discrete next state"""
+        return q_step(self.qTable, self.s1, self.s2, self.shape[0], self.low,
+                      self.inv_discretize_array, ds1, action, reward,
+                      next_state, learning_rate, discount_rate, optimazeReward)
+
+    def updateDone(self, ds, action, reward):
+        self.qTable[ds[0]*self.s1 + ds[1]*self.s2 + action] = reward
 
     def plot(self):
         """Plot the Qtable"""
         signs = ['<', ',', '>']
         colors = ["red", 'grey', "blue"]
         max = self.env.observation_space.high[0]
+        qTable = self.qTable.reshape(self.shape)
 
-        for i in range(len(self.qTable)):
+        for i in range(len(qTable)):
             x: float = round(
                 i*discretize_array[0] + self.env.observation_space.low[0], 1)
-            for j in range(len(self.qTable[0])):
+            for j in range(len(qTable[0])):
                 y: float = round(
                     j*discretize_array[1] + self.env.observation_space.low[1], 2)
 
-                action: int = np.argmax(self.qTable[i][j])
-                if (self.qTable[i][j][action] == 0):
+                action: int = np.argmax(qTable[i][j])
+                if (qTable[i][j][action] == 0):
                     action = 1
 
                 if (x >= max):
@@ -107,19 +160,9 @@ class Qtable():
         plt.title('State/Action Map (Qtable)')
         plt.show()
 
-    @staticmethod
-    def discretizeState(state, env: gym.Env):
+    def discretizeState(self, state):
         """Set the discrete state observetion length"""
-        temp = (state - env.observation_space.low) / discretize_array
-        return np.round(temp, 0).astype(int)
-
-    @staticmethod
-    def optimazeReward(reward: int, discretize_next_state, qTable):
-        """Optimaze the rewards for faster learning"""
-        if (optimazeReward is False):
-            return reward
-
-        return discretize_next_state[0] - (len(qTable) + reward)
+        return discretize_state(state, self.low, self.inv_discretize_array)
 
 
 qLearning = Qtable(env)
@@ -128,37 +171,52 @@ print(
     f'Training started for: {env_name}, target: {reward_threshold}, (last {min_episodes_criterion} runs).')
 max_episodes_tqdm = tqdm.trange(max_episodes)
 
+# Resolve env.step and the Qtable methods once, instead of an attribute lookup each step
+step = env.step
+get_action = qLearning.getAction
+train = qLearning.train
+
 # Exploring (training episodes)
+random_values = rng.random(random_block_size)
+random_actions = rng.integers(0, env.action_space.n, random_block_size)
+random_index = 0
 for episode in max_episodes_tqdm:
     episode_reward = 0
     episode_max_x = env.observation_space.low[0]
     done = False
     state, info = env.reset()
+    ds = qLearning.discretizeState(state)
 
     # Running steps of episode
     while done is not True:
         # epsilon-greedy policy, explore until epsilon nullifies
-        if (epsilon > 0 and np.random.random() < epsilon):
-            action = env.action_space.sample()
+        if (epsilon > 0 and random_values[random_index] < epsilon):
+            action = random_actions[random_index]
         else:
-            action = qLearning(state)
+            action = get_action(ds)
+        random_index += 1
+        if (random_index == random_block_size):
+            random_values = rng.random(random_block_size)
+            random_actions = rng.integers(
+                0, env.action_space.n, random_block_size)
+            random_index = 0
 
         # Take action, train, and store update episode values
-        next_state, reward, done, truncated, info = env.step(action)
-        qLearning.train(state, action, reward, next_state)
+        next_state, reward, done, truncated, info = step(action)
+        next_ds = train(ds, action, reward, next_state)
         episode_reward += reward
         episode_max_x = max(episode_max_x, next_state[0])
 
         # Allow for terminal states
         if done or next_state[0] >= 0.6:
-            qLearning.updateDone(state, action, 0)
+            qLearning.updateDone(ds, action, 0)
             done = True
 
         elif truncated:
             done = True
 
         # Prepare for next step
-        state = next_state
+        ds = next_ds
         epsilon -= epsilon_decay
 
     episodes_reward.append(episode_reward)